@@ -1,82 +1,1889 @@
-import subprocess
+from time import localtime, strftime, monotonic, time, perf_counter
+
+STARTUP = {"start": perf_counter(), "imports": [], "phases": [], "builtins": {}}
+
 import os
-from time import localtime, strftime
 import sys
+import stat
+import io
+import signal
+import importlib
+import threading
+import queue
+from collections import deque, OrderedDict
+from bisect import bisect_left
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            start = perf_counter()
+            module = importlib.import_module(self._name)
+            STARTUP["imports"].append((self._name, perf_counter() - start))
+            self.__dict__["_module"] = module
+        return getattr(self._module, attr)
+
+
+# only what the first prompt needs is imported eagerly, the rest loads on first use
+subprocess = LazyModule("subprocess")
+json = LazyModule("json")
+shlex = LazyModule("shlex")
+shutil = LazyModule("shutil")
+mmap = LazyModule("mmap")
+gzip = LazyModule("gzip")
+selectors = LazyModule("selectors")
+tempfile = LazyModule("tempfile")
+contextlib = LazyModule("contextlib")
+futures = LazyModule("concurrent.futures")
+datetime = LazyModule("datetime")
+readline = LazyModule("readline")
+asyncio = LazyModule("asyncio")
+socket = LazyModule("socket")
+
+STARTUP["phases"].append(("eager imports", perf_counter() - STARTUP["start"]))
+
+CHUNK_SIZE = 64 * 1024
+LOG_QUEUE_SIZE = 4096
+LOG_FLUSH_INTERVAL = 1.0
+LOG_FILES = {"text": "myshell.log", "jsonl": "myshell.jsonl"}
+# max_bytes and interval of 0 disable size and time based rotation
+LOG_ROTATION = {"max_bytes": 0, "interval": 0, "keep": 5, "compress": False}
+PROMPT_TEMPLATE = "myshell [{cwd}]: "
+PROMPT_TIMEOUT = 0.05
+HISTORY_FILE = os.path.expanduser("~/.myshell_history")
+READLINE_HISTORY = 1000
+CACHE_TTL = 300.0
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+STARTUP_BUDGET = 0.15
+TIMEOUT_EXIT = 124
+KILL_GRACE = 2.0
+TIMEOUT = {"default": None}
+TERMINAL = {"fd": None}
+# the command holding the terminal, and the event that wakes the main thread when it stops
+FOREGROUND = {"watch": None, "token": None, "wake": None}
+STOPPED_EXIT = 128 + signal.SIGTSTP
+PROMPT_STATE = {"cwd": os.getcwd(), "exit": 0, "duration": 0.0, "commands": 0}
 
 
 def myshell_exit():
     print("Goodbye!")
 
 
-def get_short_path():
-    path = os.getcwd().split("/")
+def get_short_path(cwd=None):
+    path = (cwd or os.getcwd()).split("/")
     parts = [x[:2] if x.startswith(".") else x[:1] for x in path]
     return "/".join(parts)
 
 
-def run_log(f, log_file):
-    time = strftime("[%Y-%m-%d %H:%M:%S]", localtime())
-    cmd, args, lines, pid, returncode = f()
-    log_file.write(f"{time} cmd: {cmd}, args: {' '.join(args)}, stdout: {lines}, pid: {pid}, exit: {returncode} \n")
-    log_file.flush()
+def get_git_branch(cwd):
+    path = cwd
+    while True:
+        git = os.path.join(path, ".git")
+        if os.path.isfile(git):
+            with open(git) as f:
+                git = os.path.join(path, f.read().partition("gitdir:")[2].strip())
+        if os.path.isdir(git):
+            with open(os.path.join(git, "HEAD")) as f:
+                head = f.read().strip()
+            return head[len("ref: refs/heads/"):] if head.startswith("ref: refs/heads/") else head[:7]
+        parent = os.path.dirname(path)
+        if parent == path:
+            return ""
+        path = parent
 
 
-def cd(command, err_file):
-    params = command.split()[1:]
-    path = params[0] if params else os.environ['HOME']
+# name -> (cache key, compute, computed off the prompt thread)
+SEGMENTS = {
+    "cwd": (lambda state: state["cwd"], lambda state: get_short_path(state["cwd"]), False),
+    "exit": (lambda state: state["exit"], lambda state: str(state["exit"]), False),
+    "duration": (lambda state: state["duration"], lambda state: f"{state['duration']:.2f}s", False),
+    "branch": (lambda state: (state["cwd"], state["commands"]), lambda state: get_git_branch(state["cwd"]), True),
+}
 
-    cmd, *args = command.split()
 
-    pid = os.getpid()
+class FieldRecorder(dict):
+    def __missing__(self, key):
+        self[key] = ""
+        return ""
+
+
+def template_fields(template):
+    # collects {names} without importing string, which drags in re
+    fields = FieldRecorder()
+    template.format_map(fields)
+    return set(fields)
+
+
+class Prompt:
+    def __init__(self, template=PROMPT_TEMPLATE, timeout=PROMPT_TIMEOUT):
+        self.template = template
+        self.timeout = timeout
+        self.fields = template_fields(template)
+        unknown = self.fields - SEGMENTS.keys()
+        if unknown:
+            raise ValueError(f"unknown prompt segments: {', '.join(sorted(unknown))}")
+        self.cache = {}
+        self.pending = {}
+        self.pool = None
+
+    def _slow(self, name, key, compute, state):
+        if name not in self.pending or self.pending[name][0] != key:
+            if self.pool is None:
+                self.pool = futures.ThreadPoolExecutor(1)
+            self.pending[name] = (key, self.pool.submit(compute, dict(state)))
+        try:
+            value = self.pending[name][1].result(self.timeout)
+        except futures.TimeoutError:
+            # keep the prompt responsive and pick the value up on a later prompt
+            return self.cache.get(name, (None, ""))[1]
+        except OSError:
+            value = ""
+        del self.pending[name]
+        self.cache[name] = (key, value)
+        return value
+
+    def render(self, state):
+        values = {}
+        for name in self.fields:
+            key_of, compute, slow = SEGMENTS[name]
+            key = key_of(state)
+            cached = self.cache.get(name)
+            if cached is not None and cached[0] == key:
+                values[name] = cached[1]
+            elif slow:
+                values[name] = self._slow(name, key, compute, state)
+            else:
+                values[name] = compute(state)
+                self.cache[name] = (key, values[name])
+        return self.template.format(**values)
+
+
+class RotatingFile:
+    def __init__(self, path, max_bytes=0, interval=0, keep=5, compress=False):
+        # `cd` moves the shell, the log stays where it was opened
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.keep = keep
+        self.compress = compress
+        self.lock = threading.RLock()
+        self._open()
+
+    def _open(self):
+        self.file = open(self.path, "a")
+        self.size = self.file.tell()
+        self.opened = monotonic()
+
+    def _due(self):
+        return ((self.max_bytes and self.size >= self.max_bytes)
+                or (self.interval and monotonic() - self.opened >= self.interval))
+
+    def write(self, text):
+        with self.lock:
+            self.file.write(text)
+            self.size += len(text)
+            if self._due():
+                self.rotate()
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def rotate(self):
+        with self.lock:
+            self.file.close()
+            # names sort in rotation order, which is what pruning relies on
+            rotated = f"{self.path}.{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+            try:
+                os.rename(self.path, rotated)
+            except OSError as e:
+                # keep logging to the current file rather than losing every later record
+                print(f"myshell: log rotation failed: {e}", file=sys.stderr)
+                rotated = None
+            self._open()
+        if rotated is not None:
+            # compression and pruning happen off the writer's path
+            rotation_pool().submit(finish_rotation, self.path, rotated, self.keep, self.compress)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+ROTATION_POOL = []
+
+
+def rotation_pool():
+    if not ROTATION_POOL:
+        ROTATION_POOL.append(futures.ThreadPoolExecutor(1))
+    return ROTATION_POOL[0]
+
+
+def finish_rotation(path, rotated, keep, compress):
+    if compress:
+        with open(rotated, "rb") as src, gzip.open(rotated + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.rename(rotated + ".gz.tmp", rotated + ".gz")
+        os.remove(rotated)
+
+    directory, name = os.path.split(path)
+    segments = sorted(f for f in os.listdir(directory)
+                      if f.startswith(name + ".") and not f.endswith(".tmp"))
+    for f in segments[:max(0, len(segments) - keep)]:
+        os.remove(os.path.join(directory, f))
+
+
+class LogWriter:
+    def __init__(self, log_file, flush_interval=LOG_FLUSH_INTERVAL, max_queue=LOG_QUEUE_SIZE):
+        self.log_file = log_file
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        # blocks when the queue is full so memory stays bounded
+        self.queue.put(line)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.log_file.flush()
+
+    def _worker(self):
+        last_flush = monotonic()
+        done = False
+        while not done:
+            timeout = max(0, self.flush_interval - (monotonic() - last_flush))
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+
+            try:
+                if batch:
+                    self.log_file.write("".join(batch))
+                if done or monotonic() - last_flush >= self.flush_interval:
+                    self.log_file.flush()
+                    last_flush = monotonic()
+            except (OSError, ValueError) as e:
+                # a dead writer would block the shell once the queue fills up
+                print(f"myshell: cannot write log: {e}", file=sys.stderr)
+
+
+class History:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.entries = None
+        self.index = None
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return mm[:]
+        except FileNotFoundError:
+            return b""
+
+    def tail(self, n):
+        # walks back from the end of the file, so startup does not depend on its size
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0 or n <= 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = size - 1 if mm[size - 1:size] == b"\n" else size
+                start = end
+                for _ in range(n):
+                    start = mm.rfind(b"\n", 0, start)
+                    if start == -1:
+                        break
+                data = mm[start + 1:end]
+        return data.decode(errors="replace").split("\n") if data else []
 
+    def load(self):
+        if self.entries is None:
+            data = self._read()
+            self.entries = data.decode(errors="replace").splitlines()
+        return self.entries
+
+    def append(self, command):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        self.file.write(command + "\n")
+        self.file.flush()
+        if self.entries is not None:
+            self.entries.append(command)
+        if self.index is not None:
+            i = bisect_left(self.index, command)
+            if i == len(self.index) or self.index[i] != command:
+                self.index.insert(i, command)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def prefix(self, prefix):
+        if self.index is None:
+            self.index = sorted(set(self.load()))
+        i = bisect_left(self.index, prefix)
+        j = bisect_left(self.index, prefix + "\U0010ffff")
+        return self.index[i:j]
+
+    def search(self, text):
+        return [(i, c) for i, c in enumerate(self.load(), 1) if text in c]
+
+
+def complete_path(text):
+    directory, prefix = os.path.split(text)
     try:
-        os.chdir(path)
+        names = os.listdir(os.path.expanduser(directory) or ".")
+    except OSError:
+        return []
+    matches = []
+    for name in sorted(names):
+        if name.startswith(prefix) and (prefix.startswith(".") or not name.startswith(".")):
+            path = os.path.join(directory, name)
+            matches.append(path + "/" if os.path.isdir(os.path.expanduser(path)) else path)
+    return matches
+
+
+def init_readline(history):
+    try:
+        readline.add_history
+    except ImportError:
+        return
+    # line editing only sees the newest READLINE_HISTORY entries so startup stays
+    # independent of the file size; the whole file is searched by `history -p` and `history -s`
+    for command in history.tail(READLINE_HISTORY):
+        readline.add_history(command)
+
+    matches = []
+
+    def complete(text, state):
+        if state == 0:
+            matches[:] = complete_path(text)
+        return matches[state] if state < len(matches) else None
+
+    readline.set_completer_delims(" \t\n;|&<>()")
+    readline.set_completer(complete)
+    readline.parse_and_bind("tab: complete")
+    readline.parse_and_bind('"\\e[A": history-search-backward')
+    readline.parse_and_bind('"\\e[B": history-search-forward')
+
+
+def format_text(record):
+    time = strftime("[%Y-%m-%d %H:%M:%S]", localtime(record["time"]))
+    if "stages" in record:
+        pid = "pipeline: " + " | ".join(
+            f"{s['cmd']}(pid {s['pid']}, exit {s['exit']}, {s['duration']:.5f}s)" for s in record["stages"])
+    else:
+        pid = f"pid: {record['pid']}"
+    usage = ""
+    if "rusage" in record:
+        u = record["rusage"]
+        usage = (f", cpu: {u['utime']:.3f}u {u['stime']:.3f}s, wall: {record['duration']:.3f}s, "
+                 f"maxrss: {u['maxrss']}K, io: {u['inblock']}/{u['oublock']}, ctx: {u['nvcsw']}/{u['nivcsw']}")
+    cached = ", cached" if record.get("cached") else ""
+    if "client" in record:
+        cached += f", client: {record['client']}, cwd: {record['cwd']}"
+    return (f"{time} cmd: {record['cmd']}, args: {' '.join(record['args'])}, stdout: {record['lines']}, "
+            f"{pid}, exit: {record['exit']}{' (timeout)' if record.get('timeout') else ''}{usage}{cached} \n")
+
+
+def format_jsonl(record):
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+FORMATTERS = {"text": format_text, "jsonl": format_jsonl}
+
+
+def run_log(f, log_file, log_format="text"):
+    start_time = time()
+    start = monotonic()
+    record = {"time": start_time, **f()}
+    record["duration"] = monotonic() - start
+    log_file.write(FORMATTERS[log_format](record))
+    return record
+
+
+BUILTINS = {}
+# builtins that change the shell state itself, so they never go to /bin/sh
+STATEFUL_BUILTINS = {"cd", "export", "hash", "jobs", "wait", "fg"}
+SHELL_CHARS = set("|&;<>()$`*?[]{}~#\n")
+HISTORY = History(HISTORY_FILE)
+ERR_LOCK = threading.Lock()
+RUNNING_GROUPS = set()
+USAGE_LOCK = threading.Lock()
+SESSION_USAGE = dict.fromkeys(["commands", "utime", "stime", "maxrss", "inblock", "oublock", "nvcsw", "nivcsw"], 0)
+JOBS = {}
+
+
+def builtin(*names):
+    def register(f):
+        for name in names:
+            BUILTINS[name] = f
+        return f
+    return register
+
+
+def write_out(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    return len(text.split('\n')), len(text.encode())
+
+
+@builtin("cd")
+def cd(args, err_file):
+    path = os.path.expanduser(os.path.expandvars(args[0])) if args else os.environ['HOME']
 
-        lines = 0
-        returncode = 0
-        return cmd, args, lines, pid, returncode
+    try:
+        os.chdir(path)
+        PROMPT_STATE["cwd"] = os.getcwd()
+        return 0, 0, 0
     except OSError as e:
         print(e, end="", file=err_file)
+        return 0, 0, 1
+
+
+@builtin("pwd")
+def pwd(args, err_file):
+    return (*write_out(os.getcwd() + "\n"), 0)
+
+
+@builtin("echo")
+def echo(args, err_file):
+    return (*write_out(" ".join(args) + "\n"), 0)
+
+
+@builtin("export")
+def export(args, err_file):
+    if not args:
+        text = "".join(f"export {k}={v}\n" for k, v in sorted(os.environ.items()))
+        return (*write_out(text), 0)
+
+    returncode = 0
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if not name.isidentifier():
+            print(f"export: not a valid identifier: {name}", file=err_file)
+            returncode = 1
+        elif sep:
+            os.environ[name] = os.path.expandvars(value)
+    return 0, 0, returncode
+
+
+@builtin("history")
+def history(args, err_file):
+    if args and args[0] == "-p" and len(args) == 2:
+        return (*write_out("".join(f"{c}\n" for c in HISTORY.prefix(args[1]))), 0)
+    if args and args[0] == "-s" and len(args) == 2:
+        return (*write_out("".join(f"{i:5}  {c}\n" for i, c in HISTORY.search(args[1]))), 0)
+    if args and args[0] == "-c" and len(args) == 1:
+        HISTORY.close()
+        open(HISTORY.path, "w").close()
+        HISTORY.entries = []
+        HISTORY.index = None
+        try:
+            readline.clear_history()
+        except ImportError:
+            pass
+        return 0, 0, 0
+    if len(args) == 1 and args[0].isdigit():
+        entries = HISTORY.tail(int(args[0]))
+        return (*write_out("".join(f"{c}\n" for c in entries)), 0)
+    if args:
+        print("usage: history [N | -p PREFIX | -s TEXT | -c]", file=err_file)
+        return 0, 0, 2
+    return (*write_out("".join(f"{i:5}  {c}\n" for i, c in enumerate(HISTORY.load(), 1))), 0)
+
+
+@builtin("true")
+def true(args, err_file):
+    return 0, 0, 0
+
+
+@builtin("false")
+def false(args, err_file):
+    return 0, 0, 1
+
+
+def split_command(command):
+    try:
+        return shlex.split(command)
+    except ValueError:
+        return None
+
+
+def is_simple(command, words):
+    return bool(words) and "=" not in words[0] and not SHELL_CHARS.intersection(command)
+
+
+def has_operators(command):
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        return any(token and not token.strip("();<>|&") for token in lexer)
+    except ValueError:
+        return True
+
+
+def find_builtin(command):
+    words = split_command(command)
+    if not words or words[0] not in BUILTINS:
+        return None
+    if words[0] in STATEFUL_BUILTINS:
+        # `export A=1; ls` is a list for /bin/sh, not arguments to export
+        return None if has_operators(command) else words
+    if not is_simple(command, words):
+        return None
+    if words[0] == "echo" and len(words) > 1 and words[1].startswith("-"):
+        # options like -n and -e are left to the external echo scripts rely on
+        return None
+    return words
+
+
+def search_path(env=None):
+    return (os.environ if env is None else env).get("PATH", os.defpath)
+
+
+class PathCache:
+    def __init__(self):
+        self.path = None
+        self.mtimes = {}
+        self.entries = {}
+        self.hits = {}
+        self.checked = False
+        # daemon connections look commands up from executor threads
+        self.lock = threading.RLock()
+
+    def clear(self):
+        with self.lock:
+            self.path = None
+            self.mtimes = None
+            self.entries.clear()
+            self.hits.clear()
+
+    def expire(self):
+        # called once per command line, PATH directories are stat'ed at most that often
+        self.checked = False
+
+    def forget(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def _dir_mtimes(self):
+        mtimes = {}
+        for d in [d or "." for d in self.path.split(os.pathsep)]:
+            try:
+                mtimes[d] = os.stat(d).st_mtime_ns
+            except OSError:
+                mtimes[d] = None
+        return mtimes
+
+    def validate(self, path=None):
+        path = path or search_path()
+        with self.lock:
+            if path != self.path:
+                self.clear()
+                self.path = path
+
+    def _installed(self):
+        # whether PATH directories changed since misses were recorded, checked once per line
+        if self.checked:
+            return False
+        self.checked = True
+        mtimes = self._dir_mtimes()
+        changed = mtimes != self.mtimes
+        self.mtimes = mtimes
+        return changed
+
+    def lookup(self, name, path=None):
+        # path is the PATH of the environment the command will run in; hits are trusted
+        # until exec fails (see popen) or `hash -r`, like sh does, so only misses cost a stat
+        if "/" in name:
+            return name if os.access(name, os.X_OK) and not os.path.isdir(name) else None
+        with self.lock:
+            self.validate(path)
+            if name in self.entries and self.entries[name] is None and self._installed():
+                for missed in [n for n, p in self.entries.items() if p is None]:
+                    del self.entries[missed]
+            if name not in self.entries:
+                self.entries[name] = shutil.which(name, path=self.path)
+                if self.entries[name] is None and self.mtimes is None:
+                    self.mtimes = self._dir_mtimes()
+            if self.entries[name] is None:
+                # misses are kept so a typo does not rescan PATH, but never shown by `hash`
+                return None
+            self.hits[name] = self.hits.get(name, 0) + 1
+            return self.entries[name]
+
+
+PATH_CACHE = PathCache()
+
 
-        lines = 0
-        returncode = 1
-        return cmd, args, lines, pid, returncode
+@builtin("hash")
+def hash_(args, err_file):
+    if not args:
+        with PATH_CACHE.lock:
+            found = [(hits, PATH_CACHE.entries[name]) for name, hits in PATH_CACHE.hits.items()
+                     if PATH_CACHE.entries.get(name)]
+        if not found:
+            return (*write_out("hash: hash table empty\n"), 0)
+        text = "hits\tcommand\n" + "".join(f"{hits:4}\t{path}\n" for hits, path in found)
+        return (*write_out(text), 0)
 
+    if args == ["-r"]:
+        PATH_CACHE.clear()
+        return 0, 0, 0
 
-def run_system(command, err_file):
-    p = subprocess.Popen(command, shell=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         universal_newlines=True)
-    stdout, stderr = p.communicate()
-    print(stderr, end="", file=err_file)
-    print(stdout, end="")
+    returncode = 0
+    for name in args:
+        if "/" in name:
+            # paths are never looked up in PATH, so there is nothing to remember
+            print(f"hash: {name}: not a command name", file=err_file)
+            returncode = 1
+            continue
+        with PATH_CACHE.lock:
+            PATH_CACHE.validate()
+            PATH_CACHE.entries.pop(name, None)
+            if PATH_CACHE.lookup(name) is None:
+                print(f"hash: {name}: not found", file=err_file)
+                returncode = 1
+            else:
+                PATH_CACHE.hits[name] = 0
+    return 0, 0, returncode
 
-    time = strftime("[%Y-%m-%d %H:%M:%S]", localtime())
+
+def popen(command, **kwargs):
+    # exec simple commands directly and only pay for /bin/sh when needed
+    words = split_command(command)
+    path = is_simple(command, words) and PATH_CACHE.lookup(words[0], search_path(kwargs.get("env")))
+    if path:
+        try:
+            return subprocess.Popen(words, executable=path, **kwargs)
+        except OSError:
+            PATH_CACHE.forget(words[0])
+            # scripts without a shebang (ENOEXEC) run under /bin/sh as they always did,
+            # and any other exec error is reported by it with the usual 126 or 127
+            pass
+    return subprocess.Popen(command, shell=True, **kwargs)
+
+
+def split_pipeline(command, env=None):
+    # only plain `a | b | c` lines are run natively, anything else goes to /bin/sh
+    if "|" not in command or SHELL_CHARS.difference("|").intersection(command):
+        return None
+    lexer = shlex.shlex(command, posix=True, punctuation_chars="|")
+    lexer.whitespace_split = True
+    try:
+        tokens = list(lexer)
+    except ValueError:
+        return None
+
+    stages = [[]]
+    for token in tokens:
+        if token == "|":
+            stages.append([])
+        elif token.startswith("|"):
+            return None
+        else:
+            stages[-1].append(token)
+
+    resolved = []
+    for words in stages:
+        path = words and "=" not in words[0] and PATH_CACHE.lookup(words[0], search_path(env))
+        if not path:
+            return None
+        resolved.append((path, words))
+    return resolved
+
+
+def process_group(pgid):
+    if sys.version_info >= (3, 11):
+        return {"process_group": pgid}
+    return {"preexec_fn": lambda: os.setpgid(0, pgid)}
+
+
+def spawn(command, stdout, stderr, stdin=None, **kwargs):
+    # every command gets its own process group so it can be killed as a whole
+    stages = split_pipeline(command, kwargs.get("env"))
+    if not stages:
+        return [popen(command, stdin=stdin, stdout=stdout, stderr=stderr, **process_group(0), **kwargs)], None
+
+    procs = []
+    first_stdin = stdin
+    try:
+        for i, (path, words) in enumerate(stages):
+            last = i == len(stages) - 1
+            p = subprocess.Popen(words, executable=path, stdin=stdin,
+                                 stdout=stdout if last else subprocess.PIPE,
+                                 stderr=stderr,
+                                 **process_group(procs[0].pid if procs else 0),
+                                 **kwargs)
+            if i > 0:
+                # the next stage owns the read end now
+                stdin.close()
+            stdin = p.stdout
+            procs.append(p)
+    except OSError:
+        # a stage that cannot be exec'd hands the whole line to /bin/sh, like popen does
+        for path, words in stages:
+            PATH_CACHE.forget(words[0])
+        for p in procs:
+            if p.stdout is not None:
+                p.stdout.close()
+        if procs:
+            signal_group(procs[0].pid, signal.SIGKILL)
+            for p in procs:
+                p.wait()
+        return [subprocess.Popen(command, shell=True, stdin=first_stdin, stdout=stdout, stderr=stderr,
+                                 **process_group(0), **kwargs)], None
+    return procs, [words for path, words in stages]
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def rusage(ru):
+    return {
+        "utime": ru.ru_utime,
+        "stime": ru.ru_stime,
+        "maxrss": ru.ru_maxrss,
+        "inblock": ru.ru_inblock,
+        "oublock": ru.ru_oublock,
+        "nvcsw": ru.ru_nvcsw,
+        "nivcsw": ru.ru_nivcsw,
+    }
+
+
+def total_rusage(usages):
+    total = {key: sum(u[key] for u in usages) for key in usages[0]}
+    total["maxrss"] = max(u["maxrss"] for u in usages)
+    return total
+
+
+def add_session_usage(usage):
+    with USAGE_LOCK:
+        SESSION_USAGE["commands"] += 1
+        for key, value in usage.items():
+            if key == "maxrss":
+                SESSION_USAGE[key] = max(SESSION_USAGE[key], value)
+            else:
+                SESSION_USAGE[key] += value
+
+
+def signal_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class Watch:
+    # children are reaped here with wait4 to get their own rusage,
+    # so nothing else may call wait()/communicate() on them
+    def __init__(self, procs, timeout=None):
+        self.procs = procs
+        self.pgid = procs[0].pid
+        self.start = monotonic()
+        self.ends = [None] * len(procs)
+        self.usages = [None] * len(procs)
+        self.durations = None
+        self.timed_out = False
+        self.done = False
+        self.stopped = False
+        self.interrupts = 0
+        self.timers = []
+        RUNNING_GROUPS.add(self.pgid)
+
+        self.threads = [threading.Thread(target=self._wait, args=(i,), daemon=True) for i in range(len(procs))]
+        for t in self.threads:
+            t.start()
+        if timeout:
+            self._schedule(timeout, self.expire)
+
+    def _wait(self, i):
+        p = self.procs[i]
+        while True:
+            # WUNTRACED, or Ctrl-Z would leave the shell waiting on a stopped child for good
+            _, status, ru = os.wait4(p.pid, os.WUNTRACED)
+            if not os.WIFSTOPPED(status):
+                break
+            self.stopped = True
+            wake = FOREGROUND["wake"]
+            if FOREGROUND["watch"] is self and wake is not None:
+                wake.set()
+        self.ends[i] = monotonic()
+        self.usages[i] = rusage(ru)
+        p.returncode = exit_code(status)
+
+    def _schedule(self, delay, f):
+        timer = threading.Timer(delay, f)
+        timer.daemon = True
+        timer.start()
+        self.timers.append(timer)
+
+    def signal(self, sig):
+        # the group may outlive our own children, e.g. when sh leaves a
+        # grandchild holding the output pipe, so it is signalled until wait() is done
+        if not self.done:
+            signal_group(self.pgid, sig)
+
+    def expire(self):
+        self.timed_out = True
+        self.signal(signal.SIGTERM)
+        self._schedule(KILL_GRACE, lambda: self.signal(signal.SIGKILL))
+
+    def interrupt(self):
+        self.interrupts += 1
+        self.signal(signal.SIGINT if self.interrupts == 1 else signal.SIGKILL)
+
+    def wait(self):
+        for t in self.threads:
+            t.join()
+        self.done = True
+        for timer in list(self.timers):
+            timer.cancel()
+        RUNNING_GROUPS.discard(self.pgid)
+        self.durations = [end - self.start for end in self.ends]
+
+
+def hand_terminal(pgid):
+    # SIGTTOU is blocked in this thread only, ignoring it would be inherited by every child
+    blocked = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+    try:
+        os.tcsetpgrp(TERMINAL["fd"], pgid)
+    except OSError:
+        pass
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+
+
+def foreground(watch, f, *args):
+    # runs under supervise(), which forwards Ctrl-C to the watch and notices Ctrl-Z
+    token = object()
+    FOREGROUND.update(watch=watch, token=token)
+    if TERMINAL["fd"] is not None:
+        hand_terminal(watch.pgid)
+    watch.stopped = False
+    watch.signal(signal.SIGCONT)
+    try:
+        r = f(*args)
+        watch.wait()
+        return r
+    finally:
+        # a command stopped meanwhile no longer owns the terminal
+        if FOREGROUND["token"] is token:
+            FOREGROUND.update(watch=None, token=None)
+            if TERMINAL["fd"] is not None:
+                hand_terminal(os.getpgrp())
+
+
+def interrupt_foreground():
+    watch = FOREGROUND["watch"]
+    if watch is not None:
+        watch.interrupt()
+
+
+def supervise(work):
+    # the command runs off the main thread, so the main thread stays free to forward
+    # Ctrl-C and to take the terminal back when Ctrl-Z stops the command;
+    # returns (value, None), or (None, (watch, thread, box)) for a stopped command
+    wake = threading.Event()
+    box = {}
+
+    def run():
+        try:
+            box["value"] = work()
+        except BaseException as e:
+            box["error"] = e
+        finally:
+            wake.set()
+
+    FOREGROUND["wake"] = wake
+    handler = signal.signal(signal.SIGINT, lambda signum, frame: interrupt_foreground())
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        wake.wait()
+    finally:
+        signal.signal(signal.SIGINT, handler)
+        FOREGROUND["wake"] = None
+
+    if "error" in box:
+        raise box["error"]
+    if "value" in box:
+        return box["value"], None
+    watch = FOREGROUND["watch"]
+    FOREGROUND.update(watch=None, token=None)
+    if TERMINAL["fd"] is not None:
+        hand_terminal(os.getpgrp())
+    return None, (watch, thread, box)
+
+
+def kill_running():
+    for pgid in list(RUNNING_GROUPS):
+        signal_group(pgid, signal.SIGKILL)
+
+
+def split_timeout(command):
+    words = split_command(command)
+    if words and words[0] == "timeout" and len(words) > 2:
+        try:
+            seconds = float(words[1])
+        except ValueError:
+            # leave coreutils timeout options alone
+            return TIMEOUT["default"], command
+        return seconds, command.split(None, 2)[2]
+    return TIMEOUT["default"], command
+
+
+def result(command, procs, stages, watch, lines, nbytes):
     cmd, *args = command.split()
-    lines = len(stdout.split('\n'))
-    pid = p.pid
-    returncode = p.returncode
+    r = {
+        "cmd": cmd,
+        "args": args,
+        "lines": lines,
+        "bytes": nbytes,
+        "pid": procs[-1].pid,
+        "exit": procs[-1].returncode,
+        "rusage": total_rusage(watch.usages),
+    }
+    if watch.timed_out:
+        r["exit"] = TIMEOUT_EXIT
+        r["timeout"] = True
+    if stages:
+        r["stages"] = [
+            {"cmd": words[0], "args": words[1:], "pid": p.pid, "exit": p.returncode, "duration": duration,
+             "rusage": usage}
+            for words, p, duration, usage in zip(stages, procs, watch.durations, watch.usages)
+        ]
+    add_session_usage(r["rusage"])
+    return r
 
-    return cmd, args, lines, pid, returncode
 
+def run_builtin(words, err_file):
+    cmd, *args = words
+    start = perf_counter()
+    lines, nbytes, returncode = BUILTINS[cmd](args, err_file)
+    # first use includes whatever the builtin loads lazily
+    STARTUP["builtins"].setdefault(cmd, perf_counter() - start)
+    return {"cmd": cmd, "args": args, "lines": lines, "bytes": nbytes, "pid": os.getpid(), "exit": returncode}
 
-def myshell_run():
-    with open("myshell.log", "a") as log_file:
-        with open("myshell.err", "a") as err_file:
-            while True:
-                try:
-                    command = input(f"myshell [{get_short_path()}]: ")
-                    if command.startswith("cd ") or command == "cd":
-                        run_log(lambda: cd(command, err_file), log_file)
-                        continue
-                    if command == "exit":
+
+def spawn_streaming(command, **kwargs):
+    # every stage writes stderr into one pipe that stream() drains next to stdout
+    err_r, err_w = os.pipe()
+    try:
+        procs, stages = spawn(command, stdout=subprocess.PIPE, stderr=err_w, **kwargs)
+    except BaseException:
+        os.close(err_r)
+        raise
+    finally:
+        os.close(err_w)
+    return procs, stages, err_r
+
+
+def write_err(chunk, err_file, line_start):
+    stamp = strftime("[%Y-%m-%d %H:%M:%S] ", localtime())
+    text = chunk.decode(errors="replace")
+    tagged = (stamp if line_start else "") + text[:-1].replace("\n", "\n" + stamp) + text[-1:]
+    with ERR_LOCK:
+        err_file.write(tagged)
+        err_file.flush()
+    return text.endswith("\n")
+
+
+def stream(p, err_fd, err_file):
+    # count the same way as len(stdout.split('\n')) without keeping stdout
+    lines = 1
+    nbytes = 0
+    line_start = True
+    out = sys.stdout.buffer
+    out_fd = p.stdout.fileno()
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(out_fd, selectors.EVENT_READ)
+        selector.register(err_fd, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, CHUNK_SIZE)
+                if not chunk:
+                    selector.unregister(key.fd)
+                elif key.fd == out_fd:
+                    lines += chunk.count(b'\n')
+                    nbytes += len(chunk)
+                    out.write(chunk)
+                    out.flush()
+                else:
+                    line_start = write_err(chunk, err_file, line_start)
+
+    p.stdout.close()
+    os.close(err_fd)
+    return lines, nbytes
+
+
+def collect(p):
+    chunks = {p.stdout.fileno(): [], p.stderr.fileno(): []}
+    with selectors.DefaultSelector() as selector:
+        for fd in chunks:
+            selector.register(fd, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, CHUNK_SIZE)
+                if chunk:
+                    chunks[key.fd].append(chunk)
+                else:
+                    selector.unregister(key.fd)
+    stdout, stderr = (b"".join(c) for c in chunks.values())
+    p.stdout.close()
+    p.stderr.close()
+    return stdout, stderr
+
+
+def run_system_buffered(command, err_file, timeout=None):
+    procs, stages = spawn(command,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    watch = Watch(procs, timeout)
+    stdout, stderr = foreground(watch, collect, procs[-1])
+    if stderr:
+        write_err(stderr, err_file, True)
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.flush()
+
+    lines = stdout.count(b'\n') + 1
+    nbytes = len(stdout)
+
+    return result(command, procs, stages, watch, lines, nbytes)
+
+
+def run_system_streaming(command, err_file, timeout=None):
+    sys.stdout.flush()
+    err_file.flush()
+    procs, stages, err_fd = spawn_streaming(command)
+    watch = Watch(procs, timeout)
+    lines, nbytes = foreground(watch, stream, procs[-1], err_fd, err_file)
+
+    return result(command, procs, stages, watch, lines, nbytes)
+
+
+class Job:
+    # the thread finishes the command and leaves its record in box["value"]
+    def __init__(self, num, command, watch, thread, box):
+        self.num = num
+        self.command = command
+        self.watch = watch
+        self.thread = thread
+        self.box = box
+
+    @property
+    def record(self):
+        return self.box.get("value")
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def wait(self):
+        self.thread.join()
+        return self.record["exit"] if self.record else 1
+
+    def status(self):
+        if not self.done():
+            return "Stopped" if self.watch.stopped else "Running"
+        if self.record and self.record["exit"] == 0:
+            return "Done"
+        return f"Exit {self.record['exit'] if self.record else 1}"
+
+
+def split_background(command):
+    command = command.rstrip()
+    if command.endswith("&") and not command.endswith("&&") and command[:-1].strip():
+        return command[:-1].rstrip()
+    return None
+
+
+def start_job(command, err_file, on_done, timeout=None):
+    num = max(JOBS, default=0) + 1
+    start_time = time()
+    start = monotonic()
+    sys.stdout.flush()
+    err_file.flush()
+    procs, stages, err_fd = spawn_streaming(command, stdin=subprocess.DEVNULL)
+    watch = Watch(procs, timeout)
+    box = {}
+
+    def run():
+        lines, nbytes = stream(procs[-1], err_fd, err_file)
+        watch.wait()
+        record = {"time": start_time, **result(command, procs, stages, watch, lines, nbytes)}
+        record["job"] = num
+        record["duration"] = monotonic() - start
+        box["value"] = record
+        on_done(record)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    JOBS[num] = Job(num, command, watch, thread, box)
+    print(f"[{num}] {procs[-1].pid}")
+
+
+def stop_job(command, watch, thread, box):
+    # a foreground command stopped with Ctrl-Z carries on as a job, fg resumes it
+    num = max(JOBS, default=0) + 1
+    JOBS[num] = job = Job(num, command, watch, thread, box)
+    print(f"\n[{num}]  {job.status():<24}{command}")
+
+
+def report_jobs():
+    for num, job in list(JOBS.items()):
+        if job.done():
+            print(f"[{num}]  {job.status():<24}{job.command}")
+            del JOBS[num]
+
+
+def get_job(args, err_file):
+    try:
+        num = int(args[0].lstrip("%")) if args else max(JOBS)
+    except ValueError:
+        num = None
+    if num not in JOBS:
+        print(f"{args[0] if args else 'current'}: no such job", file=err_file)
+        return None
+    return JOBS[num]
+
+
+def format_minutes(seconds):
+    return f"{int(seconds // 60)}m{seconds % 60:.3f}s"
+
+
+@builtin("times")
+def times(args, err_file):
+    t = os.times()
+    u = SESSION_USAGE
+    text = (f"{format_minutes(t.user)} {format_minutes(t.system)}\n"
+            f"{format_minutes(u['utime'])} {format_minutes(u['stime'])}\n"
+            f"commands: {u['commands']}, max rss: {u['maxrss']}K, block io: {u['inblock']}/{u['oublock']}, "
+            f"context switches: {u['nvcsw']}/{u['nivcsw']}\n")
+    return (*write_out(text), 0)
+
+
+@builtin("jobs")
+def jobs(args, err_file):
+    text = "".join(f"[{num}]  {job.status():<24}{job.command}\n" for num, job in JOBS.items())
+    return (*write_out(text), 0)
+
+
+@builtin("wait")
+def wait(args, err_file):
+    if not args:
+        for job in list(JOBS.values()):
+            job.wait()
+        return 0, 0, 0
+
+    returncode = 0
+    for arg in args:
+        job = get_job([arg], err_file)
+        returncode = job.wait() if job else 127
+    return 0, 0, returncode
+
+
+@builtin("fg")
+def fg(args, err_file):
+    job = get_job(args, err_file) if JOBS else None
+    if job is None:
+        if not JOBS:
+            print("fg: no current job", file=err_file)
+        return 0, 0, 1
+    print(job.command)
+    # the job takes over the terminal, Ctrl-C and Ctrl-Z like any foreground command
+    returncode, stopped = supervise(lambda: foreground(job.watch, job.wait))
+    if stopped:
+        print(f"\n[{job.num}]  {job.status():<24}{job.command}")
+        return 0, 0, STOPPED_EXIT
+    del JOBS[job.num]
+    return 0, 0, returncode
+
+
+def timed(name, f, *args, **kwargs):
+    start = perf_counter()
+    r = f(*args, **kwargs)
+    STARTUP["phases"].append((name, perf_counter() - start))
+    return r
+
+
+def print_startup_profile(final=False):
+    if not final:
+        print_row(['PHASE', 'TIME'], 24, sys.stderr)
+        for name, seconds in STARTUP["phases"]:
+            print_row([name, '{:.3f}ms'.format(seconds * 1000)], 24, sys.stderr)
+        print_row(['time to first prompt', '{:.3f}ms'.format((perf_counter() - STARTUP["start"]) * 1000)], 24, sys.stderr)
+    print_row(['LAZY IMPORT', 'TIME'], 24, sys.stderr)
+    for name, seconds in STARTUP["imports"]:
+        print_row([name, '{:.3f}ms'.format(seconds * 1000)], 24, sys.stderr)
+    if final:
+        print_row(['BUILTIN', 'FIRST USE'], 24, sys.stderr)
+        for name, seconds in STARTUP["builtins"].items():
+            print_row([name, '{:.3f}ms'.format(seconds * 1000)], 24, sys.stderr)
+
+
+def take_terminal():
+    # with a controlling terminal, foreground commands get it handed over
+    try:
+        if sys.stdin.isatty() and os.tcgetpgrp(0) == os.getpgrp():
+            TERMINAL["fd"] = 0
+    except OSError:
+        pass
+
+
+def myshell_run(run_system=run_system_streaming, flush_interval=LOG_FLUSH_INTERVAL, log_format="text",
+                prompt=None, profile=False):
+    prompt = prompt or timed("prompt template", Prompt)
+    timed("readline history", init_readline, HISTORY)
+    timed("terminal", take_terminal)
+    with timed("open log", RotatingFile, LOG_FILES[log_format], **LOG_ROTATION) as log_file:
+        with timed("open err", RotatingFile, "myshell.err", **LOG_ROTATION) as err_file:
+            log = timed("log writer", LogWriter, log_file, flush_interval)
+            formatter = FORMATTERS[log_format]
+            first_prompt = profile
+            try:
+                while True:
+                    try:
+                        report_jobs()
+                        if first_prompt:
+                            text = timed("render prompt", prompt.render, PROMPT_STATE)
+                            print_startup_profile()
+                            # from here on only imports done lazily by commands are collected
+                            STARTUP["imports"].clear()
+                            first_prompt = False
+                        else:
+                            text = prompt.render(PROMPT_STATE)
+                        command = input(text)
+                        PATH_CACHE.expire()
+                        if not command.strip():
+                            continue
+                        HISTORY.append(command)
+                        if command.strip() == "exit":
+                            break
+                        background = split_background(command)
+                        if background:
+                            timeout, background = split_timeout(background)
+                            start_job(background, err_file, lambda record: log.write(formatter(record)), timeout)
+                            continue
+                        timeout, command = split_timeout(command)
+                        words = find_builtin(command)
+                        cached = None if words else split_cached(command)
+                        if cached and find_builtin(cached):
+                            # a builtin acts on this shell, in /bin/sh it would change nothing
+                            words, cached = find_builtin(cached), None
+                            print(f"cache: {words[0]}: shell builtin, running it uncached", file=sys.stderr)
+                        if words:
+                            record = run_log(lambda: run_builtin(words, err_file), log, log_format)
+                        else:
+                            if cached:
+                                run = lambda: run_cached(cached, err_file, timeout)
+                            else:
+                                run = lambda: run_system(command, err_file, timeout)
+                            record, stopped = supervise(lambda: run_log(run, log, log_format))
+                            if stopped:
+                                stop_job(command, *stopped)
+                                PROMPT_STATE.update(exit=STOPPED_EXIT, commands=PROMPT_STATE["commands"] + 1)
+                                continue
+                        PROMPT_STATE.update(exit=record["exit"], duration=record["duration"],
+                                            commands=PROMPT_STATE["commands"] + 1)
+                    except KeyboardInterrupt:
+                        # Ctrl-C at the prompt drops the line like other shells do
+                        print()
+                    except EOFError:
                         break
-                    run_log(lambda: run_system(command, err_file), log_file)
-                except EOFError:
-                    break
+                if JOBS:
+                    print(f"waiting for {len(JOBS)} background job(s)")
+                    for job in JOBS.values():
+                        if job.watch.stopped:
+                            # stopped jobs would never finish, they are hung up like other shells do
+                            job.watch.signal(signal.SIGHUP)
+                            job.watch.signal(signal.SIGCONT)
+                        job.wait()
+            finally:
+                log.close()
+                HISTORY.close()
+            if profile:
+                print_startup_profile(final=True)
             myshell_exit()
 
 
+def read_all(f):
+    data = f.read()
+    f.close()
+    return data
+
+
+def run_captured(command, cwd=None, env=None, timeout=None, attached=False):
+    # attached runs come from the interactive loop, which forwards Ctrl-C to them
+    start_time = time()
+    start = monotonic()
+    with tempfile.TemporaryFile() as err:
+        procs, stages = spawn(command,
+                              cwd=cwd,
+                              env=env,
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=err)
+        watch = Watch(procs, timeout)
+        if attached:
+            stdout = foreground(watch, read_all, procs[-1].stdout)
+        else:
+            stdout = read_all(procs[-1].stdout)
+            watch.wait()
+        err.seek(0)
+        stderr = err.read()
+
+    record = {"time": start_time, **result(command, procs, stages, watch,
+                                             stdout.count(b'\n') + 1, len(stdout))}
+    record["duration"] = monotonic() - start
+    return record, stdout, stderr
+
+
+class OutputCache:
+    def __init__(self, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, commands=()):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.commands = set(commands)
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def key(self, command):
+        words = split_command(command)
+        return (tuple(words) if words is not None else command,
+                PROMPT_STATE["cwd"],
+                hash(frozenset(os.environ.items())))
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if monotonic() - entry[0] > self.ttl:
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        record, stdout, stderr = value
+        # timeouts, kills and failures say nothing about the next run, so they are never replayed
+        if record.get("timeout") or record["exit"] != 0:
+            return
+        size = len(stdout) + len(stderr)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (monotonic(), value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+
+OUTPUT_CACHE = OutputCache()
+
+
+def split_cached(command):
+    words = split_command(command)
+    if not words:
+        return None
+    if words[0] == "cache" and len(words) > 1:
+        return command.lstrip()[len("cache"):].lstrip()
+    if words[0] in OUTPUT_CACHE.commands:
+        return command
+    return None
+
+
+def run_cached(command, err_file, timeout=None):
+    key = OUTPUT_CACHE.key(command)
+    value = OUTPUT_CACHE.get(key)
+    cached = value is not None
+    if not cached:
+        value = run_captured(command, timeout=timeout, attached=True)
+        OUTPUT_CACHE.put(key, value)
+    record, stdout, stderr = value
+
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.flush()
+    if stderr:
+        write_err(stderr, err_file, True)
+
+    r = {k: v for k, v in record.items() if k not in ("time", "duration")}
+    r["cached"] = cached
+    return r
+
+
+def myshell_batch(path, jobs=None, fail_fast=False, flush_interval=LOG_FLUSH_INTERVAL, log_format="text"):
+    jobs = jobs or os.cpu_count() or 1
+    formatter = FORMATTERS[log_format]
+    failed = False
+
+    with RotatingFile(LOG_FILES[log_format], **LOG_ROTATION) as log_file, \
+            RotatingFile("myshell.err", **LOG_ROTATION) as err_file, \
+            (contextlib.nullcontext(sys.stdin) if path == "-" else open(path)) as commands, \
+            futures.ThreadPoolExecutor(jobs) as pool:
+        log = LogWriter(log_file, flush_interval)
+        pending = deque()
+
+        def emit(future):
+            nonlocal failed
+            record, stdout, stderr = future.result()
+            sys.stdout.buffer.write(stdout)
+            sys.stdout.flush()
+            if stderr:
+                write_err(stderr, err_file, True)
+            log.write(formatter(record))
+            failed = failed or record["exit"] != 0
+
+        def drain(block):
+            # results are emitted strictly in input order to keep output grouped
+            while pending and (block or pending[0].done() or len(pending) >= 2 * jobs):
+                emit(pending.popleft())
+                if failed and fail_fast:
+                    return
+
+        try:
+            for line in commands:
+                command = line.strip()
+                PATH_CACHE.expire()
+                if not command or command.startswith("#"):
+                    continue
+                if command == "exit":
+                    break
+                command = split_background(command) or command
+                timeout, command = split_timeout(command)
+
+                words = find_builtin(command)
+                if words:
+                    # builtins run in-process and may change cwd or env, so they are barriers
+                    drain(True)
+                    if failed and fail_fast:
+                        break
+                    record = run_log(lambda: run_builtin(words, err_file), log, log_format)
+                    failed = failed or record["exit"] != 0
+                else:
+                    pending.append(pool.submit(run_captured, command, None, None, timeout))
+                    drain(False)
+
+                if failed and fail_fast:
+                    break
+            if not (failed and fail_fast):
+                drain(True)
+        except KeyboardInterrupt:
+            kill_running()
+            failed = True
+        finally:
+            for future in pending:
+                future.cancel()
+            if failed and fail_fast:
+                # commands already running would hold up the pool's exit, their output is dropped anyway
+                kill_running()
+            log.close()
+
+    return 1 if failed else 0
+
+
+def run_builtin_in(conn, words):
+    # builtins work on the process cwd and environment, so the connection's
+    # own are swapped in around the call; nothing else runs on the event loop meanwhile,
+    # and commands on executor threads get cwd, env and PATH passed explicitly
+    start_time = time()
+    start = monotonic()
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    saved_stdout = sys.stdout
+    out = io.StringIO()
+    err = io.StringIO()
+    try:
+        os.chdir(conn["cwd"])
+        os.environ.clear()
+        os.environ.update(conn["env"])
+        sys.stdout = out
+        record = {"time": start_time, **run_builtin(words, err)}
+    finally:
+        sys.stdout = saved_stdout
+        conn["cwd"] = os.getcwd()
+        conn["env"] = dict(os.environ)
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+    record["duration"] = monotonic() - start
+    return record, out.getvalue().encode(), err.getvalue().encode()
+
+
+async def serve_client(reader, writer, num, log, formatter, err_file):
+    conn = {"cwd": os.getcwd(), "env": dict(os.environ)}
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode(errors="replace").strip()
+            PATH_CACHE.expire()
+            if not command:
+                continue
+            if command == "exit":
+                break
+
+            timeout, command = split_timeout(command)
+            words = find_builtin(command)
+            if words:
+                record, stdout, stderr = run_builtin_in(conn, words)
+            else:
+                record, stdout, stderr = await loop.run_in_executor(
+                    None, run_captured, command, conn["cwd"], conn["env"], timeout)
+            record["client"] = num
+            record["cwd"] = conn["cwd"]
+            log.write(formatter(record))
+            if stderr:
+                write_err(stderr, err_file, True)
+
+            response = {
+                "stdout": stdout.decode(errors="replace"),
+                "stderr": stderr.decode(errors="replace"),
+                "exit": record["exit"],
+                "cwd": conn["cwd"],
+            }
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(path, log, formatter, err_file):
+    clients = 0
+
+    def connected(reader, writer):
+        nonlocal clients
+        clients += 1
+        return serve_client(reader, writer, clients, log, formatter, err_file)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # the socket runs commands as this user, so it is created 0600 rather than
+    # left to the umask, and never accepts before the mode is right
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(connected, path)
+    finally:
+        os.umask(umask)
+    print(f"myshell: serving on {path}", flush=True)
+    async with server:
+        await stop.wait()
+
+
+def remove_socket(path):
+    # only a stale socket is ours to remove, never a file the path happens to name
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return True
+    if not stat.S_ISSOCK(mode):
+        return False
+    os.remove(path)
+    return True
+
+
+def myshell_serve(path, flush_interval=LOG_FLUSH_INTERVAL, log_format="text"):
+    if not remove_socket(path):
+        print(f"myshell: {path} exists and is not a socket", file=sys.stderr)
+        return 1
+    with RotatingFile(LOG_FILES[log_format], **LOG_ROTATION) as log_file, \
+            RotatingFile("myshell.err", **LOG_ROTATION) as err_file:
+        log = LogWriter(log_file, flush_interval)
+        try:
+            asyncio.run(serve(path, log, FORMATTERS[log_format], err_file))
+        finally:
+            log.close()
+            remove_socket(path)
+    myshell_exit()
+    return 0
+
+
+def myshell_connect(path):
+    returncode = 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        responses = sock.makefile("rb")
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            sock.sendall(line.encode() if line.endswith("\n") else line.encode() + b"\n")
+            if line.strip() == "exit":
+                break
+            response = responses.readline()
+            if not response:
+                break
+            response = json.loads(response)
+            sys.stdout.write(response["stdout"])
+            sys.stdout.flush()
+            sys.stderr.write(response["stderr"])
+            returncode = response["exit"]
+    return returncode
+
+
+def iter_records(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            size = len(mm)
+            while start < size:
+                end = mm.find(b"\n", start)
+                if end == -1:
+                    end = size
+                line = mm[start:end]
+                start = end + 1
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_time(s):
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.datetime.fromisoformat(s).timestamp()
+
+
+QUERY_KEYS = {
+    "cmd": lambda r: r["cmd"],
+    "exit": lambda r: r["exit"],
+    "hour": lambda r: strftime("%Y-%m-%d %H:00", localtime(r["time"])),
+    "day": lambda r: strftime("%Y-%m-%d", localtime(r["time"])),
+}
+
+
+def print_row(ar, width=13, file=None):
+    format_string = ' | '.join([f'{{:{width}.{width}}}'] * len(ar))
+    print(format_string.format(*map(str, ar)), file=file)
+
+
+def bench_startup(budget, runs):
+    timings = []
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        for _ in range(runs):
+            start = perf_counter()
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__)], cwd=home, env=env,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+            # the first bytes on stdout are the prompt
+            os.read(p.stdout.fileno(), CHUNK_SIZE)
+            timings.append(perf_counter() - start)
+            p.communicate(b"exit\n")
+
+    median = sorted(timings)[len(timings) // 2]
+    print_row(['RUNS', 'MIN', 'MEDIAN', 'BUDGET'])
+    print_row([runs, '{:.1f}ms'.format(min(timings) * 1000), '{:.1f}ms'.format(median * 1000),
+               '{:.1f}ms'.format(budget * 1000)])
+    if median > budget:
+        print("time to first prompt is over budget")
+        return 1
+    return 0
+
+
+def query(path, by="cmd", since=None, until=None):
+    key = QUERY_KEYS[by]
+    groups = {}
+    for r in iter_records(path):
+        if since is not None and r["time"] < since:
+            continue
+        if until is not None and r["time"] >= until:
+            continue
+        g = groups.setdefault(key(r), [0, 0.0, 0.0, 0, 0])
+        g[0] += 1
+        g[1] += r["duration"]
+        g[2] = max(g[2], r["duration"])
+        g[3] += r["bytes"]
+        g[4] += r["exit"] != 0
+
+    print_row([by.upper(), 'COUNT', 'TOTAL TIME', 'MAX TIME', 'STDOUT BYTES', 'FAILED'])
+    for name, (count, total, longest, nbytes, failed) in sorted(groups.items(), key=lambda x: -x[1][1]):
+        print_row([name, count, '{:.5f}s'.format(total), '{:.5f}s'.format(longest), nbytes, failed])
+
+
+def query_main(argv):
+    path = LOG_FILES["jsonl"]
+    by = "cmd"
+    since = until = None
+
+    while argv:
+        arg = argv.pop(0)
+        if arg == "--log" and argv:
+            path = argv.pop(0)
+        elif arg == "--by" and argv and argv[0] in QUERY_KEYS:
+            by = argv.pop(0)
+        elif arg in ("--since", "--until") and argv:
+            try:
+                value = parse_time(argv.pop(0))
+            except ValueError:
+                print_usage()
+                return 2
+            if arg == "--since":
+                since = value
+            else:
+                until = value
+        else:
+            print_usage()
+            return 2
+
+    try:
+        query(path, by, since, until)
+    except OSError as e:
+        print(f"query: {path}: {e.strerror}", file=sys.stderr)
+        return 1
+    except (ValueError, KeyError):
+        print(f"query: {path} is not a JSONL log, write one with --log-format jsonl", file=sys.stderr)
+        return 1
+    return 0
+
+
+def print_usage():
+    print('usage: AP5.py [--buffered] [--flush-interval SECONDS] [--log-format text|jsonl] \n'
+          '                [--batch FILE|- [--jobs N] [--fail-fast]] [--prompt TEMPLATE] \n'
+          '                [--cache CMD[,CMD...]] [--cache-ttl SECONDS] [--cache-size BYTES] \n'
+          '                [--rotate-size BYTES] [--rotate-interval SECONDS] [--rotate-keep N] [--rotate-gzip] \n'
+          '                [--profile-startup] [--timeout SECONDS] \n'
+          '                prefix a command with `timeout SECONDS` to limit just that command \n'
+          '       AP5.py --serve SOCKET     run commands for clients on a unix socket \n'
+          '       AP5.py --connect SOCKET   send commands from stdin to a --serve daemon \n'
+          '                TEMPLATE segments: {cwd} {exit} {duration} {branch} \n'
+          '                prefix a command with `cache` to memoize its output \n'
+          '       AP5.py query [--log FILE] [--by cmd|exit|hour|day] [--since TIME] [--until TIME] \n'
+          '                    TIME is a unix timestamp or YYYY-MM-DD[THH:MM:SS] \n'
+          '       AP5.py bench-startup [--budget MS] [--runs N]     fails if time to first prompt is over MS')
+
+
+def main():
+    argv = sys.argv[1:]
+    run_system = run_system_streaming
+    flush_interval = LOG_FLUSH_INTERVAL
+    log_format = "text"
+    batch = None
+    jobs = None
+    fail_fast = False
+    prompt = None
+    profile = False
+    serve = connect = None
+
+    if argv and argv[0] == "query":
+        sys.exit(query_main(argv[1:]))
+
+    if argv and argv[0] == "bench-startup":
+        budget = STARTUP_BUDGET
+        runs = 10
+        argv = argv[1:]
+        while argv:
+            arg = argv.pop(0)
+            if arg == "--budget" and argv:
+                budget = float(argv.pop(0)) / 1000
+            elif arg == "--runs" and argv and argv[0].isdigit() and int(argv[0]) > 0:
+                runs = int(argv.pop(0))
+            else:
+                print_usage()
+                return
+        sys.exit(bench_startup(budget, runs))
+
+    while argv:
+        arg = argv.pop(0)
+        if arg == "--buffered":
+            run_system = run_system_buffered
+        elif arg == "--flush-interval" and argv:
+            flush_interval = float(argv.pop(0))
+        elif arg == "--log-format" and argv and argv[0] in FORMATTERS:
+            log_format = argv.pop(0)
+        elif arg == "--batch" and argv:
+            batch = argv.pop(0)
+        elif arg == "--jobs" and argv and argv[0].isdigit() and int(argv[0]) > 0:
+            jobs = int(argv.pop(0))
+        elif arg == "--fail-fast":
+            fail_fast = True
+        elif arg == "--timeout" and argv:
+            TIMEOUT["default"] = float(argv.pop(0))
+        elif arg == "--serve" and argv:
+            serve = argv.pop(0)
+        elif arg == "--connect" and argv:
+            connect = argv.pop(0)
+        elif arg == "--profile-startup":
+            profile = True
+        elif arg == "--rotate-size" and argv and argv[0].isdigit():
+            LOG_ROTATION["max_bytes"] = int(argv.pop(0))
+        elif arg == "--rotate-interval" and argv:
+            LOG_ROTATION["interval"] = float(argv.pop(0))
+        elif arg == "--rotate-keep" and argv and argv[0].isdigit():
+            LOG_ROTATION["keep"] = int(argv.pop(0))
+        elif arg == "--rotate-gzip":
+            LOG_ROTATION["compress"] = True
+        elif arg == "--cache" and argv:
+            OUTPUT_CACHE.commands.update(filter(None, argv.pop(0).split(",")))
+        elif arg == "--cache-ttl" and argv:
+            OUTPUT_CACHE.ttl = float(argv.pop(0))
+        elif arg == "--cache-size" and argv and argv[0].isdigit():
+            OUTPUT_CACHE.max_bytes = int(argv.pop(0))
+        elif arg == "--prompt" and argv:
+            try:
+                prompt = Prompt(argv.pop(0))
+            except ValueError as e:
+                print(e)
+                return
+        else:
+            print_usage()
+            return
+
+    if serve is not None:
+        sys.exit(myshell_serve(serve, flush_interval, log_format))
+        return
+    if connect is not None:
+        sys.exit(myshell_connect(connect))
+    if batch is not None:
+        sys.exit(myshell_batch(batch, jobs, fail_fast, flush_interval, log_format))
+    myshell_run(run_system, flush_interval, log_format, prompt, profile)
+
+
 if __name__ == '__main__':
-    myshell_run()
+    main()
@@ -1,8 +1,130 @@
 # Python 3.7.5
 
+import os
 import sys
+
+
+def worker(file, *size):
+    # only os and sys are loaded before the program reports ready, so STARTUP is
+    # close to what `python3 FILE` pays; the rest is imported after that
+    file = os.path.abspath(file)
+    with open(file, 'rb') as f:
+        try:
+            code = compile(f.read(), file, 'exec')
+        except SyntaxError as e:
+            import json
+            print('ready\n' + json.dumps({'error': f'SyntaxError: {e}'}))
+            return
+    sys.argv = [file] + list(size)
+    sys.path[0] = os.path.dirname(file)
+
+    # results go through a copy of stdout, the program's own output is discarded
+    report = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    report.write('ready\n')
+    report.flush()
+
+    import json
+    import time
+    import timeit
+    import resource
+
+    def body():
+        try:
+            exec(code, {'__name__': '__main__', '__file__': file, '__builtins__': __builtins__})
+        except SystemExit:
+            pass
+
+    # the interpreter's own footprint, left out when fitting memory against n
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    # the first run pays for the program's imports, so it is timed on its own
+    first_start = time.perf_counter()
+    try:
+        body()
+    except Exception as e:
+        report.write(json.dumps({'error': f'{type(e).__name__}: {e}'}) + '\n')
+        report.flush()
+        return
+    first = time.perf_counter() - first_start
+
+    # autorange runs growing batches, CPU time is spread over all of them
+    runs = []
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    loops, total = timeit.Timer(body).autorange(lambda number, _: runs.append(number))
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    report.write(json.dumps({
+        'first': first,
+        'loops': loops,
+        'time': total / loops,
+        'rss': after.ru_maxrss * 1024,
+        'base_rss': base_rss,
+        'user': (after.ru_utime - before.ru_utime) / sum(runs),
+        'sys': (after.ru_stime - before.ru_stime) / sum(runs),
+        'cpu': (after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime) / sum(runs),
+    }) + '\n')
+    report.flush()
+
+
+if __name__ == '__main__' and len(sys.argv) in (3, 4) and sys.argv[1] == '--worker':
+    worker(*sys.argv[2:])
+    sys.exit()
+
 import subprocess
 import time
+import math
+import statistics
+import queue
+import resource
+import json
+import timeit
+import hashlib
+import platform
+import functools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# two-sided 95% Student's t quantiles by degrees of freedom
+T_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+    11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093,
+    20: 2.086, 21: 2.080, 22: 2.074, 23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048,
+    29: 2.045, 30: 2.042,
+}
+
+# what each --rank-by choice sorts on
+RANK_BY = {'wall': 'time', 'memory': 'rss', 'cpu': 'cpu'}
+
+STORE_FILE = 'ap1_results.jsonl'
+
+# the runner's own nice value, --priority is counted from it
+NICENESS = os.getpriority(os.PRIO_PROCESS, 0)
+
+
+def print_usage():
+    print('usage: AP1.py [--warmup N] [--trials N] [--jobs N] [--isolate] [--priority N] [--in-process]\n'
+          '              [--rank-by wall|memory|cpu] [--store PATH]\n'
+          '              [--adaptive] [--target PCT] [--budget SECONDS]\n'
+          '              [--sweep START:STOP[:FACTOR]] [files]\n'
+          '       AP1.py compare [--store PATH] [--metric wall|memory|cpu] [--alpha P] [--threshold PCT] [files]\n'
+          '    --isolate       pin each program to its own core\n'
+          '    --priority N    run trials N nice levels above this process (needs privileges)\n'
+          '    --in-process    time only the program body in a started worker, report startup apart\n'
+          '    --rank-by X     rank by wall time (default), peak memory or user+sys CPU time\n'
+          '    --store PATH    results file every run is appended to (default {})\n'
+          '    compare         check the latest run of each file against its previous version\n'
+          '    --alpha P       significance level of the Mann-Whitney test (default 0.05)\n'
+          '    --threshold PCT smallest slowdown of the median that counts (default 5)\n'
+          '    --adaptive      add trials round-robin until every 95% CI is within --target percent\n'
+          '                    of its mean (default 5) or --budget seconds pass (default 60),\n'
+          '                    --trials becomes the minimum per program\n'
+          '    --sweep S:E:F   run every program for n = S, S*F, S*F^2, ... up to E (default F 10),\n'
+          '                    n is passed as argv[1] and in $AP1_N, log-log fits show how time\n'
+          '                    and memory grow with n; sweeps are always timed --in-process'.format(STORE_FILE))
 
 
 def print_row(ar, width=13):
@@ -10,32 +132,604 @@ def print_row(ar, width=13):
     print(format_string.format(*map(str, ar)))
 
 
-def run_time(file):
-    start_time = time.time()
+def seconds(value):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if value * scale >= 1:
+            return '{:.5g}{}'.format(value * scale, unit)
+    return '{:.5g}ns'.format(value * 1e9)
+
+
+def megabytes(value):
+    return '{:.1f}MB'.format(value / 2 ** 20)
+
+
+def isolate(core=None, priority=0):
+    # runs in the thread that is about to spawn the trial: on Linux affinity and nice
+    # value belong to the thread and the child inherits them, so it is pinned from
+    # interpreter startup on without a preexec_fn, which is unsafe with threads
+    if core is not None:
+        os.sched_setaffinity(0, {core})
+    if priority:
+        os.setpriority(os.PRIO_PROCESS, 0, NICENESS - priority)
+
+
+def reap(process):
+    # wait4 instead of Popen.wait, it hands back the child's own rusage
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return usage
+
+
+def exit_error(returncode):
+    if returncode < 0:
+        return RuntimeError(f'killed by signal {-returncode}')
+    return RuntimeError(f'exited with status {returncode}')
 
-    subprocess.call(
-        ["python3", file],
+
+def size_env(n):
+    if n is None:
+        return None
+    return dict(os.environ, AP1_N=str(n))
+
+
+def run_time(file, core=None, priority=0, n=None):
+    isolate(core, priority)
+    start_time = time.perf_counter_ns()
+
+    process = subprocess.Popen(
+        ["python3", file] + ([str(n)] if n is not None else []),
         stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
+        stderr=subprocess.DEVNULL,
+        env=size_env(n)
+    )
+    usage = reap(process)
+    if process.returncode != 0:
+        # a crashed run is no measurement, it is reported like an in-process failure
+        raise exit_error(process.returncode)
+
+    return {
+        'time': (time.perf_counter_ns() - start_time) / 1e9,
+        'rss': usage.ru_maxrss * 1024,
+        'user': usage.ru_utime,
+        'sys': usage.ru_stime,
+        'cpu': usage.ru_utime + usage.ru_stime,
+    }
+
+
+def run_in_process(file, core=None, priority=0, n=None):
+    isolate(core, priority)
+    start_time = time.perf_counter_ns()
+
+    process = subprocess.Popen(
+        ["python3", os.path.abspath(__file__), '--worker', file] + ([str(n)] if n is not None else []),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+        env=size_env(n)
     )
+    process.stdout.readline()
+    startup = (time.perf_counter_ns() - start_time) / 1e9
+
+    line = process.stdout.readline()
+    reap(process)
+    process.stdout.close()
+    if not line:
+        raise exit_error(process.returncode)
+
+    result = json.loads(line)
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    result['startup'] = startup
+    return result
+
+
+def measure(file, warmup, trials, core=None, priority=0, runner=run_time):
+    for _ in range(warmup):
+        runner(file, core, priority)
+    return [runner(file, core, priority) for _ in range(trials)]
+
+
+def split_failed(files, all_results):
+    # a program that failed has its error in place of its results
+    failed = [(file, r) for file, r in zip(files, all_results) if isinstance(r, Exception)]
+    measured = [(file, r) for file, r in zip(files, all_results) if not isinstance(r, Exception)]
+    return [file for file, _ in measured], [r for _, r in measured], failed
+
+
+def print_failed(failed):
+    for file, error in failed:
+        print(f'{file} failed: {error}')
+
+
+def relative_width(values):
+    s = summarize(values)
+    return (s['ci_high'] - s['ci_low']) / s['mean'] if s['mean'] else 0.0
+
+
+def measure_adaptive(files, run, map, warmup, min_trials, target, budget, key):
+    results = {file: [] for file in files}
+    for _ in range(warmup):
+        for file, result in zip(files, map(run, files)):
+            if isinstance(result, Exception):
+                results[file] = result
+
+    pending = [file for file in files if not isinstance(results[file], Exception)]
+    deadline = time.monotonic() + budget
+    # one trial per unsettled program per round, so drift hits every program alike
+    while pending and time.monotonic() < deadline:
+        for file, result in zip(pending, map(run, pending)):
+            if isinstance(result, Exception):
+                results[file] = result
+            else:
+                results[file].append(result)
+        pending = [
+            file for file in pending
+            if not isinstance(results[file], Exception)
+            and (len(results[file]) < max(min_trials, 2)
+                 or relative_width([r[key] for r in results[file]]) > target)
+        ]
+
+    return [results[file] for file in files], pending
+
+
+def geometric(start, stop, factor):
+    sizes = []
+    n = start
+    while n <= stop:
+        sizes.append(n)
+        n = max(n + 1, round(n * factor))
+    return sizes
+
+
+def loglog_fit(points):
+    # least squares slope of log y against log n, the k in y ~ n^k
+    points = [(math.log(n), math.log(y)) for n, y in points if n > 0 and y > 0]
+    if len(points) < 2:
+        return None, None
+    mean_x = statistics.mean(x for x, _ in points)
+    mean_y = statistics.mean(y for _, y in points)
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    syy = sum((y - mean_y) ** 2 for _, y in points)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return sxy / sxx, sxy * sxy / (sxx * syy) if syy else 1.0
 
-    return time.time() - start_time
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def can_raise_priority(priority):
+    if os.geteuid() == 0:
+        return True
+    lowest_nice = 20 - resource.getrlimit(resource.RLIMIT_NICE)[0]
+    return NICENESS - priority >= lowest_nice
+
+
+def governor(core):
+    try:
+        with open(f'/sys/devices/system/cpu/cpu{core}/cpufreq/scaling_governor') as f:
+            return f.read().strip()
+    except OSError:
+        return 'unknown'
+
+
+def print_environment(cores, priority):
+    print('load average: {:.2f} {:.2f} {:.2f}'.format(*os.getloadavg()))
+    for core in sorted(set(cores)):
+        print(f'cpu{core} governor: {governor(core)}')
+    if priority:
+        print(f'priority: +{priority}')
+
+
+def summarize(times):
+    n = len(times)
+    stdev = statistics.stdev(times) if n > 1 else 0.0
+    ci = T_95.get(n - 1, 1.96) * stdev / math.sqrt(n) if n > 1 else 0.0
+    mean = statistics.mean(times)
+    return {
+        'mean': mean,
+        'median': statistics.median(times),
+        'stdev': stdev,
+        'min': min(times),
+        'ci_low': mean - ci,
+        'ci_high': mean + ci,
+    }
+
+
+def indistinguishable(a, b):
+    return a['ci_low'] <= b['ci_high'] and b['ci_low'] <= a['ci_high']
+
+
+def mann_whitney(baseline, current):
+    # one-sided p-value that current tends to be larger, normal approximation with tie correction
+    values = sorted([(v, 0) for v in baseline] + [(v, 1) for v in current])
+    n = len(values)
+    rank_sum = 0.0
+    ties = 0
+    i = 0
+    while i < n:
+        j = i
+        while j < n and values[j][0] == values[i][0]:
+            j += 1
+        rank = (i + j + 1) / 2
+        rank_sum += rank * sum(1 for _, group in values[i:j] if group == 1)
+        ties += (j - i) ** 3 - (j - i)
+        i = j
+
+    n1, n2 = len(baseline), len(current)
+    u = rank_sum - n2 * (n2 + 1) / 2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def interpreter():
+    return subprocess.check_output(
+        ["python3", "-c", "import platform; print(platform.python_implementation(), platform.python_version())"],
+        universal_newlines=True
+    ).strip()
+
+
+def save(store, files, hashes, all_results, in_process, n=None):
+    python = interpreter()
+    with open(store, 'a') as f:
+        for file, results in zip(files, all_results):
+            f.write(json.dumps({
+                'timestamp': datetime.now().isoformat(),
+                'file': file,
+                'hash': hashes[file],
+                'python': python,
+                'host': platform.node(),
+                'mode': 'in-process' if in_process else 'process',
+                'n': n,
+                'results': results,
+            }) + '\n')
+
+
+def load(store):
+    try:
+        with open(store) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def compare(args):
+    store = STORE_FILE
+    metric = 'wall'
+    alpha = 0.05
+    threshold = 5.0
+    files = []
+
+    while args:
+        arg = args.pop(0)
+        try:
+            if arg == '--store' and args:
+                store = args.pop(0)
+            elif arg == '--metric' and args and args[0] in RANK_BY:
+                metric = args.pop(0)
+            elif arg == '--alpha' and args:
+                alpha = float(args.pop(0))
+            elif arg == '--threshold' and args:
+                threshold = float(args.pop(0))
+            elif arg.startswith('--'):
+                print_usage()
+                return 2
+            else:
+                files.append(arg)
+        except ValueError:
+            print_usage()
+            return 2
+
+    records = load(store)
+    python = interpreter()
+    host = platform.node()
+    if not files:
+        files = sorted({r['file'] for r in records})
+
+    key = RANK_BY[metric]
+    show = megabytes if metric == 'memory' else seconds
+    regressions = 0
+
+    print_row(['PROGRAM', 'BASELINE', 'CURRENT', 'CHANGE', 'P-VALUE', 'VERDICT'])
+    for file in files:
+        # only runs from this machine and interpreter are comparable
+        runs = [r for r in records if r['file'] == file and r['python'] == python and r['host'] == host]
+        if not runs:
+            print_row([file, '-', '-', '-', '-', 'no runs'])
+            continue
+        current = runs[-1]
+        previous = [
+            r for r in runs
+            if r['hash'] != current['hash'] and r['mode'] == current['mode'] and r.get('n') == current.get('n')
+        ]
+        if not previous:
+            print_row([file, '-', '-', '-', '-', 'no baseline'])
+            continue
+        baseline = previous[-1]
+
+        before = [r[key] for r in baseline['results']]
+        after = [r[key] for r in current['results']]
+        change = statistics.median(after) / statistics.median(before) - 1
+        p = mann_whitney(before, after)
+        regressed = p < alpha and change * 100 >= threshold
+        regressions += regressed
+
+        print_row([
+            file,
+            show(statistics.median(before)),
+            show(statistics.median(after)),
+            '{:+.1%}'.format(change),
+            '{:.4f}'.format(p),
+            'REGRESSION' if regressed else 'ok',
+        ])
+
+    return 1 if regressions else 0
+
+
+def scaling(files, hashes, sizes, collect, store, rank_by):
+    # always timed in-process, interpreter startup jitter swamps the body at small n
+    by_size = {}
+    unsettled = set()
+    failed = []
+    for n in sizes:
+        results, pending = collect(functools.partial(run_in_process, n=n), files)
+        # a program that fails at one size has no curve, it is left out of the larger ones
+        files, results, errors = split_failed(files, results)
+        failed += [(f'{file} at n={n}', error) for file, error in errors]
+        unsettled.update(pending)
+        save(store, files, hashes, results, True, n)
+        by_size[n] = dict(zip(files, results))
+
+    print_row(['PROGRAM', 'N', 'MEDIAN', '95% CI', 'CPU', 'PEAK RSS'])
+    curves = {file: {'time': [], 'cpu': [], 'rss': []} for file in files}
+    for file in files:
+        for n in sizes:
+            results = by_size[n][file]
+            s = summarize([r['time'] for r in results])
+            cpu = statistics.median(r['cpu'] for r in results)
+            rss = statistics.median(r['rss'] for r in results)
+            extra = statistics.median(r['rss'] - r['base_rss'] for r in results)
+            curves[file]['time'].append((n, s['median']))
+            curves[file]['cpu'].append((n, cpu))
+            curves[file]['rss'].append((n, extra))
+            print_row([
+                f'{file}*' if file in unsettled else file,
+                n,
+                seconds(s['median']),
+                '±' + seconds((s['ci_high'] - s['ci_low']) / 2),
+                seconds(cpu),
+                megabytes(rss),
+            ])
+
+    fits = []
+    for file in files:
+        fit = {key: loglog_fit(points) for key, points in curves[file].items()}
+        fits.append((file, fit))
+    # programs without a usable fit sort last
+    fits.sort(key=lambda x: (x[1][RANK_BY[rank_by]][0] is None, x[1][RANK_BY[rank_by]][0] or 0))
+
+    def exponent(fit):
+        k, r2 = fit
+        return '-' if k is None else 'n^{:.2f} {:.2f}'.format(k, r2)
+
+    print()
+    print_row(['PROGRAM', 'RANK', 'TIME', 'CPU', 'MEMORY'])
+    for rank, (file, fit) in enumerate(fits):
+        print_row([file, rank + 1, exponent(fit['time']), exponent(fit['cpu']), exponent(fit['rss'])])
+    print('exponents are log-log least squares fits over n, followed by R^2, of the in-process '
+          'body time; memory is peak RSS above the worker before the first run')
+    if unsettled:
+        print('* budget ran out before the 95% CI settled at some n')
+    print_failed(failed)
 
 
 def main():
-    files = sys.argv[1:]
+    args = sys.argv[1:]
+    warmup = 1
+    trials = 5
+    jobs = 1
+    isolate = False
+    priority = 0
+    in_process = False
+    rank_by = 'wall'
+    store = STORE_FILE
+    adaptive = False
+    target = 5.0
+    budget = 60.0
+    sizes = None
+    files = []
+
+    if args and args[0] == 'compare':
+        sys.exit(compare(args[1:]))
+
+    while args:
+        arg = args.pop(0)
+        if arg in ('--warmup', '--trials', '--jobs', '--priority') and args and args[0].isdigit():
+            value = int(args.pop(0))
+            if arg == '--warmup':
+                warmup = value
+            elif arg == '--priority':
+                priority = value
+            elif arg == '--trials' and value > 0:
+                trials = value
+            elif arg == '--jobs' and value > 0:
+                jobs = value
+            else:
+                print_usage()
+                return
+        elif arg == '--isolate':
+            isolate = True
+        elif arg == '--in-process':
+            in_process = True
+        elif arg == '--rank-by' and args and args[0] in RANK_BY:
+            rank_by = args.pop(0)
+        elif arg == '--store' and args:
+            store = args.pop(0)
+        elif arg == '--adaptive':
+            adaptive = True
+        elif arg in ('--target', '--budget') and args:
+            try:
+                value = float(args.pop(0))
+            except ValueError:
+                value = 0
+            if value <= 0:
+                print_usage()
+                return
+            if arg == '--target':
+                target = value
+            else:
+                budget = value
+        elif arg == '--sweep' and args:
+            try:
+                bounds = args.pop(0).split(':')
+                start, stop = int(bounds[0]), int(bounds[1])
+                factor = float(bounds[2]) if len(bounds) == 3 else 10.0
+            except (ValueError, IndexError):
+                start, stop, factor = 0, 0, 0
+            sizes = geometric(start, stop, factor) if start > 0 and factor > 1 and len(bounds) <= 3 else []
+            if len(sizes) < 2:
+                print('--sweep needs START:STOP[:FACTOR] with 0 < START, FACTOR > 1 and at least two sizes')
+                return
+        elif arg.startswith('--'):
+            print_usage()
+            return
+        else:
+            files.append(arg)
 
     if not files:
-        print("usage: AP1.py [files]")
+        print_usage()
         return
 
-    with_times_sorted = sorted(zip(files, map(run_time, files)), key=lambda x: x[1])
+    # hashed up front, the programs may change while they are measured
+    hashes = {}
+    for file in files:
+        try:
+            hashes[file] = file_hash(file)
+        except OSError as e:
+            print(f'cannot read {file}: {e.strerror}')
+            return
+
+    cores = [None] * jobs
+    if isolate:
+        if not hasattr(os, 'sched_setaffinity'):
+            print('--isolate needs os.sched_setaffinity, which this platform lacks')
+            return
+        available = available_cores()
+        if jobs > len(available):
+            print(f'--isolate with --jobs {jobs} needs {jobs} cores, only {len(available)} available')
+            return
+        # the highest cores, core 0 usually takes most interrupts
+        cores = available[-jobs:]
+
+    if priority and not can_raise_priority(priority):
+        print(f'not allowed to raise priority by {priority}, run as root or raise RLIMIT_NICE')
+        return
+
+    print_environment([c for c in cores if c is not None], priority)
+
+    # programs measured at the same time never share a core
+    free_cores = queue.Queue()
+    for core in cores:
+        free_cores.put(core)
+
+    def collect(runner, files):
+        def measure_on_free_core(file):
+            core = free_cores.get()
+            try:
+                return measure(file, warmup, trials, core, priority, runner)
+            except RuntimeError as e:
+                return e
+            finally:
+                free_cores.put(core)
+
+        def run_on_free_core(file):
+            core = free_cores.get()
+            try:
+                return runner(file, core, priority)
+            except RuntimeError as e:
+                return e
+            finally:
+                free_cores.put(core)
+
+        # programs run side by side only when asked, they compete for cores otherwise
+        with ThreadPoolExecutor(jobs) as pool:
+            if adaptive:
+                return measure_adaptive(
+                    files, run_on_free_core, pool.map, warmup, trials, target / 100, budget, RANK_BY[rank_by]
+                )
+            return list(pool.map(measure_on_free_core, files)), []
+
+    if sizes:
+        scaling(files, hashes, sizes, collect, store, rank_by)
+        return
+
+    all_results, unsettled = collect(run_in_process if in_process else run_time, files)
+    files, all_results, failed = split_failed(files, all_results)
+    if failed and not files:
+        print_failed(failed)
+        return
+    save(store, files, hashes, all_results, in_process)
+
+    stats = []
+    for file, results in zip(files, all_results):
+        s = summarize([r['time'] for r in results])
+        for key in ('rss', 'user', 'sys', 'cpu'):
+            s[key] = statistics.median(r[key] for r in results)
+        s['rank'] = summarize([r[RANK_BY[rank_by]] for r in results])
+        if in_process:
+            s['startup'] = statistics.median(r['startup'] for r in results)
+            s['first'] = statistics.median(r['first'] for r in results)
+            s['loops'] = min(r['loops'] for r in results)
+        s['trials'] = len(results)
+        stats.append((file, s))
+    stats.sort(key=lambda x: x[1]['rank']['median'])
+
+    header = ['PROGRAM', 'RANK', 'MEDIAN', 'MEAN', 'STDEV', 'MIN', '95% CI', 'PEAK RSS', 'USER', 'SYS', 'CPU/WALL']
+    if adaptive:
+        header += ['TRIALS']
+    if in_process:
+        header += ['LOOPS', 'FIRST RUN', 'STARTUP']
+    print_row(header)
 
-    print_row(['PROGRAM', 'RANK', 'TIME ELAPSED'])
+    ties = False
+    for rank, (file, s) in enumerate(stats):
+        tied = rank > 0 and indistinguishable(s['rank'], stats[rank - 1][1]['rank'])
+        ties = ties or tied
+        row = [
+            file,
+            f'{rank + 1}~' if tied else rank + 1,
+            seconds(s['median']),
+            seconds(s['mean']),
+            seconds(s['stdev']),
+            seconds(s['min']),
+            '±' + seconds((s['ci_high'] - s['ci_low']) / 2),
+            megabytes(s['rss']),
+            seconds(s['user']),
+            seconds(s['sys']),
+            '{:.0%}'.format(s['cpu'] / s['median']),
+        ]
+        if adaptive:
+            row += [f"{s['trials']}*" if file in unsettled else s['trials']]
+        if in_process:
+            row += [s['loops'], seconds(s['first']), seconds(s['startup'])]
+        print_row(row)
 
-    for rank, row in enumerate(with_times_sorted):
-        print_row([row[0], rank + 1, '{:.5f}s'.format(row[1])])
+    if ties:
+        print('~ confidence interval overlaps the program ranked above')
+    if unsettled:
+        print(f'* budget of {budget:g}s ran out before the 95% CI was within {target:g}% of the mean')
+    print_failed(failed)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()